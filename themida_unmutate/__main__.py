@@ -1,4 +1,8 @@
+from multiprocessing import freeze_support
+
 from themida_unmutate.main import entry_point
 
 if __name__ == "__main__":
+    # Needed for worker processes to work in PyInstaller builds
+    freeze_support()
     entry_point()
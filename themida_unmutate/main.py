@@ -1,7 +1,15 @@
+import os
+import pickle
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import AbstractContextManager, nullcontext
+from functools import cache
+from itertools import repeat
+from multiprocessing import get_context
+from typing import Optional
 
 from themida_unmutate.logging import setup_logger, logger
-from themida_unmutate.miasm_utils import MiasmContext
+from themida_unmutate.miasm_utils import MiasmContext, dump_miasm_object
 from themida_unmutate.rebuilding import rebuild_simplified_binary
 from themida_unmutate.symbolic_execution import disassemble_and_simplify_functions
 from themida_unmutate.unwrapping import unwrap_functions
@@ -19,29 +27,40 @@ def entry_point() -> None:
 
     # Resolve mutated functions' addresses if needed
     protected_func_addrs = list(map(lambda addr: int(addr, 0), args.addresses))
-    if not args.no_trampoline:
-        logger.info("Resolving mutated's functions' addresses...")
-        mutated_func_addrs = unwrap_functions(miasm_ctx, protected_func_addrs)
-    else:
-        # No trampolines to take care of, use target addresses directly
-        mutated_func_addrs = protected_func_addrs
+    # Functions are processed independently from each other, so spread the
+    # work across several processes when possible
+    jobs = min(args.jobs, len(protected_func_addrs))
+    with _create_executor(jobs, args.verbose) as executor:
+        if not args.no_trampoline:
+            logger.info("Resolving mutated's functions' addresses...")
+            if executor is None:
+                mutated_func_addrs = unwrap_functions(miasm_ctx, protected_func_addrs)
+            else:
+                mutated_func_addrs = list(
+                    executor.map(_unwrap_function, repeat(args.protected_binary), protected_func_addrs))
+        else:
+            # No trampolines to take care of, use target addresses directly
+            mutated_func_addrs = protected_func_addrs
 
-    # Disassemble mutated functions and simplify them
-    logger.info("Deobfuscating mutated functions...")
-    simplified_func_asmcfgs = disassemble_and_simplify_functions(miasm_ctx, mutated_func_addrs)
+        # Disassemble mutated functions and simplify them
+        logger.info("Deobfuscating mutated functions...")
+        if executor is None:
+            simplified_func_asmcfgs = disassemble_and_simplify_functions(miasm_ctx, mutated_func_addrs)
+        else:
+            simplified_func_asmcfgs = [
+                pickle.loads(simplified_func) for simplified_func in executor.map(
+                    _disassemble_and_simplify_function, repeat(args.protected_binary), mutated_func_addrs)
+            ]
 
     # Map protected functions' addresses to their corresponding simplified `AsmCFG`
-    func_addr_to_simplified_cfg = {
-        protected_func_addrs[i]: asm_cfg
-        for i, asm_cfg in enumerate(simplified_func_asmcfgs)
-    }
+    func_addr_to_simplified_cfg = dict(zip(protected_func_addrs, simplified_func_asmcfgs))
 
     # Rewrite the protected binary with simplified functions
     logger.info("Rebuilding binary file...")
     rebuild_simplified_binary(miasm_ctx, func_addr_to_simplified_cfg, args.protected_binary, args.output,
                               args.reassemble_in_place)
 
-    logger.info("Done! You can find your deobfuscated binary at '%s'" % args.output)
+    logger.info("Done! You can find your deobfuscated binary at '%s'", args.output)
 
 
 def parse_arguments() -> Namespace:
@@ -57,10 +76,57 @@ def parse_arguments() -> Namespace:
                         action='store_true',
                         help="Rewrite simplified code over the mutated code "
                         "rather than in a new code section")
+    parser.add_argument("-j",
+                        "--jobs",
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help="Number of processes used to deobfuscate functions in parallel "
+                        "(defaults to the number of CPUs)")
     parser.add_argument("-v", "--verbose", action='store_true', help="Enable verbose logging")
 
     return parser.parse_args()
 
 
+def _create_executor(jobs: int, verbose: bool) -> AbstractContextManager[Optional[ProcessPoolExecutor]]:
+    """
+    Create a process pool with `jobs` workers, or nothing if the work should
+    be done in the current process.
+    """
+    if jobs <= 1:
+        return nullcontext()
+
+    # Note: use "spawn" on all platforms to get the same behavior as on Windows
+    return ProcessPoolExecutor(max_workers=jobs,
+                               mp_context=get_context("spawn"),
+                               initializer=setup_logger,
+                               initargs=(verbose, ))
+
+
+def _unwrap_function(target_binary_path: str, target_function_addr: int) -> int:
+    """
+    Worker resolving a single mutated function's address. Unwrapping only
+    returns addresses, so each worker process can safely reuse its Miasm context
+    for all the functions it's given.
+    """
+    miasm_ctx = _load_unwrapping_context(target_binary_path)
+    return unwrap_functions(miasm_ctx, [target_function_addr])[0]
+
+
+@cache
+def _load_unwrapping_context(target_binary_path: str) -> MiasmContext:
+    return MiasmContext.from_binary_file(target_binary_path)
+
+
+def _disassemble_and_simplify_function(target_binary_path: str, mutated_func_addr: int) -> bytes:
+    """
+    Worker simplifying a single mutated function in its own Miasm context.
+    The resulting `AsmCFG` is sent back serialized to the parent process, along
+    with its own `LocationDB`.
+    """
+    miasm_ctx = MiasmContext.from_binary_file(target_binary_path)
+    simplified_funcs = disassemble_and_simplify_functions(miasm_ctx, [mutated_func_addr])
+    return dump_miasm_object(simplified_funcs[0])
+
+
 if __name__ == "__main__":
     entry_point()
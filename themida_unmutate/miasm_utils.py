@@ -1,15 +1,19 @@
+import io
+import pickle
+import struct
 from dataclasses import dataclass
-from typing import Optional, Self
+from functools import cached_property
+from types import SimpleNamespace
+from typing import Any, Iterable, Optional, Self
 
 import miasm.expression.expression as m2_expr
 import miasm.core.asmblock as m2_asmblock
 from miasm.analysis.binary import Container
 from miasm.analysis.machine import Machine
-from miasm.core import parse_asm
-from miasm.core.asmblock import disasmEngine, AsmCFG, asm_resolve_final
-from miasm.core.cpu import cls_mn
+from miasm.core.asmblock import disasmEngine, AsmCFG
+from miasm.core.cpu import bsi, cls_mn
 from miasm.core.interval import interval
-from miasm.core.locationdb import LocationDB
+from miasm.core.locationdb import LocationDB, LocKey
 from miasm.ir.ir import Lifter
 
 MiasmFunctionInterval = interval
@@ -21,7 +25,6 @@ class MiasmContext:
     container: Container
     machine: Machine
     mdis: disasmEngine
-    lifter: Lifter
 
     @classmethod
     def from_binary_file(cls, target_binary_path: str) -> Self:
@@ -35,9 +38,16 @@ class MiasmContext:
         assert machine.dis_engine is not None
 
         mdis = machine.dis_engine(container.bin_stream, loc_db=loc_db)
-        lifter = machine.lifter(loc_db)
 
-        return cls(loc_db, container, machine, mdis, lifter)
+        return cls(loc_db, container, machine, mdis)
+
+    @cached_property
+    def lifter(self) -> Lifter:
+        """
+        Lifter sharing the context's `LocationDB`. It's only instantiated when
+        first needed, as reassembling code doesn't require it.
+        """
+        return self.machine.lifter(self.loc_db)
 
     @property
     def arch(self) -> str:
@@ -55,31 +65,67 @@ def expr_int_to_int(expr: m2_expr.ExprInt) -> int:
     return int(result)
 
 
-def generate_code_redirect_patch(miasm_ctx: MiasmContext, src_addr: int, dst_addr: int) -> tuple[int, bytes]:
+class _MiasmPickler(pickle.Pickler):
+    """
+    Pickler able to serialize Miasm's instructions.
+
+    x86 instructions keep a reference to the bit field which matched their
+    prefix, and bit fields are instances of classes generated at runtime, which
+    cannot be pickled. Only their default value is used after disassembly so
+    replace them with a plain object holding that value.
+    """
+
+    def reducer_override(self, obj: Any) -> Any:
+        if isinstance(obj, bsi):
+            return SimpleNamespace, (), {"default": obj.default}
+
+        return NotImplemented
+
+
+def dump_miasm_object(obj: Any) -> bytes:
+    """
+    Serialize an object containing Miasm instructions (e.g., an `AsmCFG`).
+    """
+    buffer = io.BytesIO()
+    _MiasmPickler(buffer).dump(obj)
+    return buffer.getvalue()
+
+
+def unset_location_offsets(loc_db: LocationDB, loc_keys: Iterable[LocKey]) -> None:
     """
-    Generate a single-block AsmCFG with a JMP from `src_addr` to `dst_addr` and return the result patch.
+    Disassociate `loc_keys` from their offset, if they have one.
     """
-    X86_JMP_INSTRUCTION = "JMP"
-
-    # Generate a single-block AsmCFG with a JMP to the simplified version
-    original_loc_str = f"loc_{src_addr:x}"
-    jmp_unmut_instr_str = f"{original_loc_str}:\n{X86_JMP_INSTRUCTION} 0x{dst_addr:x}"
-    jmp_unmut_asmcfg = parse_asm.parse_txt(miasm_ctx.mdis.arch, miasm_ctx.mdis.attrib, jmp_unmut_instr_str,
-                                           miasm_ctx.mdis.loc_db)
-
-    # Unpin loc_key if it's pinned
-    original_loc = miasm_ctx.loc_db.get_offset_location(src_addr)
-    if original_loc is not None:
-        miasm_ctx.loc_db.unset_location_offset(original_loc)
-
-    # Relocate the newly created block and generate machine code
-    original_loc = miasm_ctx.loc_db.get_name_location(original_loc_str)
-    miasm_ctx.loc_db.set_location_offset(original_loc, src_addr)
-    jmp_patches = asm_resolve_final(miasm_ctx.mdis.arch, jmp_unmut_asmcfg)
-    jmp_patch: Optional[tuple[int, bytes]] = next(iter(jmp_patches.items()), None)
-    assert jmp_patch is not None
-
-    return jmp_patch
+    loc_key_to_offset = getattr(loc_db, "_loc_key_to_offset", None)
+    offset_to_loc_key = getattr(loc_db, "_offset_to_loc_key", None)
+    if not isinstance(loc_key_to_offset, dict) or not isinstance(offset_to_loc_key, dict):
+        # `LocationDB`'s internals changed, fall back to the public API
+        for loc_key in loc_keys:
+            if loc_db.get_location_offset(loc_key) is not None:
+                loc_db.unset_location_offset(loc_key)
+        return
+
+    # Update `LocationDB`'s mappings directly, as going through
+    # `unset_location_offset` for each `LocKey` is costly on big CFGs
+    for loc_key in loc_keys:
+        offset = loc_key_to_offset.pop(loc_key, None)
+        if offset is not None:
+            del offset_to_loc_key[offset]
+
+
+def generate_code_redirect_patch(src_addr: int, dst_addr: int) -> tuple[int, bytes]:
+    """
+    Generate a patch with a JMP from `src_addr` to `dst_addr`.
+    """
+    X86_JMP_REL32_OPCODE = b"\xE9"
+    X86_JMP_REL32_SIZE = 5
+
+    # Always use the `JMP rel32` form, its encoding is simple enough to not
+    # need Miasm's assembler
+    rel_offset = dst_addr - (src_addr + X86_JMP_REL32_SIZE)
+    if not -2**31 <= rel_offset < 2**31:
+        raise ValueError(f"Cannot redirect 0x{src_addr:x} to 0x{dst_addr:x}, destination is too far")
+
+    return src_addr, X86_JMP_REL32_OPCODE + struct.pack("<i", rel_offset)
 
 
 # Custom version of miasm's `asm_resolve_final` which works better for our
@@ -1,14 +1,21 @@
-from typing import Optional
+from bisect import bisect_right
+from dataclasses import dataclass
+from operator import itemgetter
+from typing import Optional, Self
 
 import lief
 from miasm.core.asmblock import AsmCFG, asm_resolve_final, bbl_simplifier
 from miasm.core.interval import interval
+from miasm.core.locationdb import LocKey
 
 from themida_unmutate.miasm_utils import (MiasmContext, MiasmFunctionInterval, generate_code_redirect_patch,
-                                          asm_resolve_final_in_place)
+                                          asm_resolve_final_in_place, unset_location_offsets)
 
 NEW_SECTION_NAME = ".unmut"
 NEW_SECTION_MAX_SIZE = 2**16
+NEW_SECTION_CHARACTERISTICS = (lief.PE.Section.CHARACTERISTICS.CNT_CODE.value
+                               | lief.PE.Section.CHARACTERISTICS.MEM_READ.value
+                               | lief.PE.Section.CHARACTERISTICS.MEM_EXECUTE.value)
 
 
 def rebuild_simplified_binary(
@@ -49,82 +56,83 @@ def __rebuild_simplified_binary_in_new_section(
         raise Exception(f"Failed to parse PE '{input_binary_path}'")
 
     # Create a new code section
-    unmut_section = lief.PE.Section([0] * NEW_SECTION_MAX_SIZE, NEW_SECTION_NAME,
-                                    lief.PE.Section.CHARACTERISTICS.CNT_CODE.value
-                                    | lief.PE.Section.CHARACTERISTICS.MEM_READ.value
-                                    | lief.PE.Section.CHARACTERISTICS.MEM_EXECUTE.value)
+    # Note: LIEF's content constructor only takes a `list[int]`, set the
+    # content from a zeroed buffer instead of building a list of `int`s
+    unmut_section = lief.PE.Section(NEW_SECTION_NAME)
+    unmut_section.characteristics = NEW_SECTION_CHARACTERISTICS
+    unmut_section.content = memoryview(bytes(NEW_SECTION_MAX_SIZE))
     pe_obj.add_section(unmut_section)
     unmut_section = pe_obj.get_section(NEW_SECTION_NAME)
     unmut_section_base = pe_obj.imagebase + unmut_section.virtual_address
 
-    # Reassemble simplified AsmCFGs
-    original_to_simplified: dict[int, int] = {}
-    next_min_offset_for_asm = 0
-    unmut_section_patches: list[tuple[int, bytes]] = []
+    # Merge simplified AsmCFGs, to reassemble as many functions as possible at
+    # once. Only CFGs which share a `LocationDB` but no basic block can be merged
+    # together (`AsmCFG`s produced by worker processes come with their own
+    # `LocationDB`).
+    asmcfg_groups: list[tuple[AsmCFG, dict[int, LocKey]]] = []
     for protected_func_addr, val in \
             func_addr_to_simplified_cfg.items():
         original_code_addr, simplified_asmcfg, _ = val
         # Simplify CFG further (by merging basic blocks when possible)
         simplified_asmcfg = bbl_simplifier(simplified_asmcfg)
 
-        # Unpin blocks to be able to relocate the whole CFG
-        head = miasm_ctx.loc_db.get_offset_location(original_code_addr)
-        for ir_block in simplified_asmcfg.blocks:
-            miasm_ctx.loc_db.unset_location_offset(ir_block.loc_key)
+        loc_db = simplified_asmcfg.loc_db
+        for merged_asmcfg, merged_heads in asmcfg_groups:
+            if merged_asmcfg.loc_db is loc_db and merged_asmcfg.nodes().isdisjoint(simplified_asmcfg.nodes()):
+                break
+        else:
+            merged_asmcfg, merged_heads = AsmCFG(loc_db), {}
+            asmcfg_groups.append((merged_asmcfg, merged_heads))
 
-        # Relocate the function's entry block
-        miasm_ctx.loc_db.set_location_offset(head, unmut_section_base + next_min_offset_for_asm)
+        for block in simplified_asmcfg.blocks:
+            merged_asmcfg.add_block(block)
+        merged_heads[protected_func_addr] = loc_db.get_offset_location(original_code_addr)
+
+    # Reassemble merged AsmCFGs
+    arch = miasm_ctx.mdis.arch
+    original_to_simplified: dict[int, int] = {}
+    next_min_offset_for_asm = 0
+    unmut_section_patches: list[tuple[int, bytes]] = []
+    for merged_asmcfg, merged_heads in asmcfg_groups:
+        loc_db = merged_asmcfg.loc_db
+        # Unpin blocks to let Miasm relocate the whole CFG into the new section
+        unset_location_offsets(loc_db, (ir_block.loc_key for ir_block in merged_asmcfg.blocks))
 
         # Generate the simplified machine code
         new_section_patches = asm_resolve_final(
-            miasm_ctx.mdis.arch,
-            simplified_asmcfg,
+            arch,
+            merged_asmcfg,
             dst_interval=interval([(unmut_section_base + next_min_offset_for_asm,
                                     unmut_section_base + unmut_section.virtual_size - next_min_offset_for_asm)]))
 
         # Merge patches into the patch list
-        for patch in new_section_patches.items():
-            unmut_section_patches.append(patch)
+        unmut_section_patches.extend(new_section_patches.items())
 
-        # Associate original addr to simplified addr
-        original_to_simplified[protected_func_addr] = min(new_section_patches.keys())
-        next_min_offset_for_asm = max(new_section_patches.keys()) - unmut_section_base + 15
+        # Associate original addrs to simplified addrs
+        for protected_func_addr, head in merged_heads.items():
+            original_to_simplified[protected_func_addr] = loc_db.get_location_offset(head)
+        # Next CFGs go right after the last instruction written
+        next_min_offset_for_asm = max(addr + len(data)
+                                      for addr, data in new_section_patches.items()) - unmut_section_base
 
     # Overwrite the new section's content
     new_section_size = next_min_offset_for_asm
-    new_content = bytearray([0] * new_section_size)
-    for addr, data in unmut_section_patches:
-        offset = addr - unmut_section_base
-        new_content[offset:offset + len(data)] = data
+    new_content = bytearray(new_section_size)
+    __apply_patches(new_content, unmut_section_base, unmut_section_patches)
     unmut_section.content = memoryview(new_content)
 
     # Redirect functions to their simplified versions
-    protected_function_addrs = func_addr_to_simplified_cfg.keys()
-    unmut_jmp_patches: list[tuple[int, bytes]] = []
-    for target_addr in protected_function_addrs:
-        # Generate a single-block AsmCFG with a JMP to the simplified version
-        simplified_func_addr = original_to_simplified[target_addr]
-        unmut_jmp_patch = generate_code_redirect_patch(miasm_ctx, target_addr, simplified_func_addr)
-        unmut_jmp_patches.append(unmut_jmp_patch)
-
-    # Find the section containing the original function
-    text_section = __section_from_virtual_address(pe_obj, next(iter(protected_function_addrs)))
-    assert text_section is not None
+    unmut_jmp_patches = [
+        generate_code_redirect_patch(target_addr, original_to_simplified[target_addr])
+        for target_addr in func_addr_to_simplified_cfg.keys()
+    ]
 
     # Apply patches
-    text_section_base = pe_obj.imagebase + text_section.virtual_address
-    text_section_bytes = bytearray(text_section.content)
-    for addr, data in unmut_jmp_patches:
-        offset = addr - text_section_base
-        text_section_bytes[offset:offset + len(data)] = data
-    text_section.content = memoryview(text_section_bytes)
-
-    # Invoke the builder
-    builder = lief.PE.Builder(pe_obj)
-    builder.build()
+    section_index = _SectionIndex.from_binary(pe_obj)
+    __patch_binary(pe_obj, section_index, unmut_jmp_patches)
 
     # Save the result
-    builder.write(output_binary_path)
+    __write_binary(pe_obj, output_binary_path)
 
 
 def __rebuild_simplified_binary_in_place(
@@ -143,6 +151,7 @@ def __rebuild_simplified_binary_in_place(
         raise Exception(f"Failed to parse PE '{input_binary_path}'")
 
     # Reassemble simplified AsmCFGs
+    arch = miasm_ctx.mdis.arch
     original_to_simplified: dict[int, int] = {}
     unmut_patches: list[tuple[int, bytes]] = []
     for protected_func_addr, val in \
@@ -150,69 +159,135 @@ def __rebuild_simplified_binary_in_place(
         original_code_addr, simplified_asmcfg, orignal_asmcfg_interval = val
 
         # Generate the simplified machine code
-        new_section_patches = asm_resolve_final_in_place(miasm_ctx.loc_db,
-                                                         miasm_ctx.mdis.arch,
+        new_section_patches = asm_resolve_final_in_place(simplified_asmcfg.loc_db,
+                                                         arch,
                                                          simplified_asmcfg,
                                                          dst_interval=orignal_asmcfg_interval)
 
         # Merge patches into the patch list
-        for patch in new_section_patches.items():
-            unmut_patches.append(patch)
+        unmut_patches.extend(new_section_patches.items())
 
         # Associate original addr to simplified addr
         original_to_simplified[protected_func_addr] = original_code_addr
 
     # Find Themida's section
     mutated_func_addr = next(iter(original_to_simplified.values()))
-    themida_section = __section_from_virtual_address(pe_obj, mutated_func_addr)
+    section_index = _SectionIndex.from_binary(pe_obj)
+    themida_section = section_index.section_from_virtual_address(mutated_func_addr)
     assert themida_section is not None
 
     # Overwrite Themida's section content
     themida_section_base = pe_obj.imagebase + themida_section.virtual_address
     new_content = bytearray(themida_section.content)
-    for addr, data in unmut_patches:
-        offset = addr - themida_section_base
-        new_content[offset:offset + len(data)] = data
+    __apply_patches(new_content, themida_section_base, unmut_patches)
     themida_section.content = memoryview(new_content)
 
     # Redirect functions to their simplified versions
-    protected_function_addrs = func_addr_to_simplified_cfg.keys()
-    unmut_jmp_patches: list[tuple[int, bytes]] = []
-    for target_addr in protected_function_addrs:
-        # Generate a single-block AsmCFG with a JMP to the simplified version
-        simplified_func_addr = original_to_simplified[target_addr]
-        unmut_jmp_patch = generate_code_redirect_patch(miasm_ctx, target_addr, simplified_func_addr)
-        unmut_jmp_patches.append(unmut_jmp_patch)
-
-    # Find the section containing the original function
-    text_section = __section_from_virtual_address(pe_obj, next(iter(protected_function_addrs)))
-    assert text_section is not None
+    unmut_jmp_patches = [
+        generate_code_redirect_patch(target_addr, original_to_simplified[target_addr])
+        for target_addr in func_addr_to_simplified_cfg.keys()
+    ]
 
     # Apply patches
-    text_section_base = pe_obj.imagebase + text_section.virtual_address
-    text_section_bytes = bytearray(text_section.content)
-    for addr, data in unmut_jmp_patches:
-        offset = addr - text_section_base
-        text_section_bytes[offset:offset + len(data)] = data
-    text_section.content = memoryview(text_section_bytes)
-
-    # Invoke the builder
-    builder = lief.PE.Builder(pe_obj)
-    builder.build()
+    __patch_binary(pe_obj, section_index, unmut_jmp_patches)
 
     # Save the result
-    builder.write(output_binary_path)
+    __write_binary(pe_obj, output_binary_path)
 
 
-def __section_from_virtual_address(lief_bin: lief.Binary, virtual_addr: int) -> Optional[lief.Section]:
-    rva = virtual_addr - lief_bin.imagebase
-    return __section_from_rva(lief_bin, rva)
+def __write_binary(pe_obj: lief.PE.Binary, output_binary_path: str) -> None:
+    """
+    Rebuild `pe_obj` and write it to `output_binary_path`.
+    """
+    builder = lief.PE.Builder(pe_obj)
+    # Only sections were added or patched, so don't let LIEF rebuild metadata
+    # that we didn't touch (and might not round-trip perfectly). Note: these are
+    # LIEF's defaults, but be explicit about it.
+    builder.build_imports(False)
+    builder.patch_imports(False)
+    builder.build_relocations(False)
+    builder.build_tls(False)
+    builder.build_resources(False)
+    builder.build_overlay(True)
+    builder.build()
+    # Note: let LIEF write its buffer to the file directly, `get_build` would
+    # return a copy of the whole binary as a `list[int]`
+    builder.write(output_binary_path)
 
 
-def __section_from_rva(lief_bin: lief.Binary, rva: int) -> Optional[lief.Section]:
-    for s in lief_bin.sections:
-        if s.virtual_address <= rva < s.virtual_address + s.size:
+def __apply_patches(content: bytearray, content_base: int, patches: list[tuple[int, bytes]]) -> None:
+    """
+    Write `patches` into `content`, whose first byte is located at `content_base`.
+    """
+    # Write through a `memoryview` in address order: each write becomes a plain
+    # copy into the existing buffer and the buffer cannot be resized by mistake
+    content_view = memoryview(content)
+
+    def write_run(run_addr: int, run_data: list[bytes]) -> None:
+        data = b"".join(run_data)
+        offset = run_addr - content_base
+        content_view[offset:offset + len(data)] = data
+
+    # Patches usually are contiguous instructions, coalesce them to copy whole
+    # runs of bytes at once
+    run_addr = run_end = 0
+    run_data: list[bytes] = []
+    for addr, data in sorted(patches, key=itemgetter(0)):
+        if addr != run_end and len(run_data) > 0:
+            write_run(run_addr, run_data)
+            run_data = []
+        if len(run_data) == 0:
+            run_addr = addr
+        run_data.append(data)
+        run_end = addr + len(data)
+    if len(run_data) > 0:
+        write_run(run_addr, run_data)
+
+
+@dataclass
+class _SectionIndex:
+    """
+    Sections of a binary sorted by RVA, to look them up by address without
+    walking LIEF's section list each time.
+    """
+    imagebase: int
+    section_starts: list[int]
+    sections: list[tuple[int, int, lief.Section]]
+
+    @classmethod
+    def from_binary(cls, lief_bin: lief.Binary) -> Self:
+        """
+        Index the sections of `lief_bin`. The index must be rebuilt if sections
+        are added to the binary.
+        """
+        sections = sorted(((s.virtual_address, s.virtual_address + s.size, s) for s in lief_bin.sections),
+                          key=itemgetter(0))
+        return cls(lief_bin.imagebase, [start for start, _, _ in sections], sections)
+
+    def section_from_virtual_address(self, virtual_addr: int) -> Optional[lief.Section]:
+        rva = virtual_addr - self.imagebase
+        return self.section_from_rva(rva)
+
+    def section_from_rva(self, rva: int) -> Optional[lief.Section]:
+        i = bisect_right(self.section_starts, rva) - 1
+        if i < 0:
+            return None
+
+        start, end, s = self.sections[i]
+        if start <= rva < end:
             assert isinstance(s, lief.Section)
             return s
 
-    return None
+        return None
+
+
+def __patch_binary(pe_obj: lief.PE.Binary, section_index: _SectionIndex, patches: list[tuple[int, bytes]]) -> None:
+    """
+    Write `patches` directly into `pe_obj`'s sections. Contrary to rewriting a
+    whole section's content, only the patched bytes are copied, which is
+    cheaper for a few small patches.
+    """
+    for addr, data in patches:
+        # LIEF silently ignores patches that fall outside of the binary's sections
+        assert section_index.section_from_virtual_address(addr) is not None
+        pe_obj.patch_address(addr, list(data), lief.Binary.VA_TYPES.VA)
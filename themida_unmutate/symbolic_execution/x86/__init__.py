@@ -44,7 +44,7 @@ def disassemble_and_simplify_functions(
     # Iterate through functions, disassemble and simplify them
     simplified_func_asmcfgs: list[tuple[int, AsmCFG, MiasmFunctionInterval]] = []
     for mutated_code_addr in mutated_func_addrs:
-        logger.info("Simplifying function at 0x%x..." % mutated_code_addr)
+        logger.info("Simplifying function at 0x%x...", mutated_code_addr)
 
         # Disassemble function
         asm_cfg = miasm_ctx.mdis.dis_multiblock(mutated_code_addr)
@@ -57,7 +57,7 @@ def disassemble_and_simplify_functions(
 
         # Process IR basic blocks
         for loc_key, ir_block in ir_cfg.blocks.items():
-            logger.debug("%s:" % str(loc_key))
+            logger.debug("%s:", loc_key)
             asm_block = asm_cfg.loc_key_to_block(loc_key)
             if asm_block is None:
                 # Some instructions such `idiv` generate multiple IR basic blocks from a single asm instruction, so we
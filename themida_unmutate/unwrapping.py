@@ -12,12 +12,12 @@ def unwrap_functions(miasm_ctx: MiasmContext, target_function_addrs: list[int])
     """
     mutated_func_addrs: list[int] = []
     for addr in target_function_addrs:
-        logger.debug("Resolving mutated code portion address for 0x%x..." % addr)
+        logger.debug("Resolving mutated code portion address for 0x%x...", addr)
         mutated_code_addr = _resolve_mutated_code_address(miasm_ctx, addr)
         if mutated_code_addr == addr:
             raise Exception("Failure to unwrap function")
 
-        logger.info("Function at 0x%x jumps to 0x%x" % (addr, mutated_code_addr))
+        logger.info("Function at 0x%x jumps to 0x%x", addr, mutated_code_addr)
         mutated_func_addrs.append(mutated_code_addr)
 
     return mutated_func_addrs